@@ -0,0 +1,106 @@
+# Import-time benchmark for the backend (python -X importtime breakdown)
+#
+#   python bench_importtime.py                 # report for `import main`
+#   python bench_importtime.py --module cvmodel
+#   python bench_importtime.py --output importtime.json --baseline benchmarks/importtime.json
+#
+# The tracked number is main's own cost: the time `import main` takes beyond importing the
+# reference module (--reference, flask by default), both read from the same -X importtime trace.
+# flask dominates the total and is the noisiest part of it, so this is what changes when the
+# backend gets heavier. With --baseline the script exits with status 1 when the median own cost
+# grew by more than --tolerance (plus --slack-ms for timer noise). Record baselines on the machine
+# that runs the check, with enough --runs for a stable median.
+
+import argparse
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+
+BACKEND_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+def measure(module):
+    # Runs `import <module>` in a fresh interpreter and parses the -X importtime lines
+    # ("import time: self [us] | cumulative | imported package") from stderr
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module],
+                            cwd=BACKEND_DIR, capture_output=True, text=True)
+    if result.returncode != 0:
+        sys.exit(result.stderr)
+
+    imports = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|")
+        depth = (len(name) - len(name.lstrip())) // 2
+        imports.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return imports
+
+
+def summarise(imports, reference, top):
+    # Total for the benchmarked module, the part of it spent importing the reference module,
+    # and the slowest top-level packages it pulled in
+    total_us = imports[-1][2]
+    reference_us = next((cumulative_us for name, _, cumulative_us, _ in imports if name == reference), 0)
+    packages = {}
+    for name, self_us, cumulative_us, depth in imports:
+        package = name.split(".")[0]
+        packages[package] = packages.get(package, 0) + self_us
+    slowest = sorted(packages.items(), key=lambda item: item[1], reverse=True)[:top]
+    return total_us, reference_us, slowest
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Import-time benchmark for the backend")
+    parser.add_argument("--module", default="main")
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters to run; the median is reported")
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--output", help="write the results as JSON")
+    parser.add_argument("--baseline", help="JSON from an earlier --output run to compare against")
+    parser.add_argument("--reference", default="flask", help="module whose import time is excluded from the module's own cost")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed relative growth of the own cost against the baseline")
+    parser.add_argument("--slack-ms", type=float, default=3.0, help="allowed absolute growth on top of --tolerance")
+    args = parser.parse_args()
+
+    runs = [summarise(measure(args.module), args.reference, args.top) for _ in range(args.runs)]
+    total_us = statistics.median(total for total, _, _ in runs)
+    reference_us = statistics.median(reference for _, reference, _ in runs)
+    own_us = statistics.median(total - reference for total, reference, _ in runs)
+    runs.sort(key=lambda run: run[0] - run[1])
+    _, _, slowest = runs[len(runs) // 2]
+
+    print(f"import {args.module}: {total_us / 1000:.1f} ms, {args.reference} {reference_us / 1000:.1f} ms, "
+          f"own {own_us / 1000:.1f} ms (medians of {args.runs})")
+    print(f"{'package':<30} {'self ms':>10}")
+    for package, self_us in slowest:
+        print(f"{package:<30} {self_us / 1000:>10.1f}")
+
+    results = {"module": args.module, "runs": args.runs, "total_ms": total_us / 1000,
+               "reference": args.reference, "reference_ms": reference_us / 1000, "own_ms": own_us / 1000,
+               "machine": {"platform": platform.platform(), "processor": platform.processor() or platform.machine(),
+                           "cpus": os.cpu_count(), "python": platform.python_version()},
+               "packages_ms": {package: self_us / 1000 for package, self_us in slowest}}
+    if args.output:
+        with open(args.output, "w") as fp:
+            json.dump(results, fp, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as fp:
+            baseline = json.load(fp)
+        if baseline["module"] != args.module:
+            sys.exit(f"baseline is for import {baseline['module']}, not {args.module}")
+        if baseline.get("reference") != args.reference or "own_ms" not in baseline:
+            sys.exit(f"baseline was not recorded as an own cost excluding {args.reference}; re-record it with --output")
+        limit = baseline["own_ms"] * (1 + args.tolerance) + args.slack_ms
+        print(f"baseline own cost: {baseline['own_ms']:.1f} ms (median of {baseline['runs']} on "
+              f"{baseline['machine']['platform']}), limit: {limit:.1f} ms")
+        if own_us / 1000 > limit:
+            print("Import time regressed")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
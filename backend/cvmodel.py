@@ -1,13 +1,36 @@
 import cv2
 import numpy as np
-from matplotlib import pyplot as plt
 import math
 import os
 import pickle
 import copy
+import heapq
+import csv
 
 #save me opencv holy moly - Alan
 
+# Catalog names (stars.csv / /visible) that don't map onto a template file name by removing spaces
+TEMPLATE_ALIASES = {
+    "Antlia": ["Antilia"],
+    "Boötes": ["Bootes"],
+    "Chamaleon": ["Chamaeleon"],
+    "Microscopium": ["Microscopus"],
+    "Ophiucus": ["Ophiuchus"],
+    "Pisces Austrinus": ["PiscisAustrinus"],
+    "Serpens": ["SerpensCaput", "SerpensCauda"],
+    "Triangulum Australe": ["TriangulumAustralis"],
+}
+
+# Template store used for matching; point it at "Catalog Template Coordinates" to use makeCatalogTemplates output
+TEMPLATE_STORE = os.environ.get("TEMPLATE_STORE", "Template Coordinates")
+
+# Unpickled template stores, keyed by file path
+_template_cache = {}
+
+# Logistic model behind a match's confidence: (intercept, per matched non-reference star, per unit
+# of log score). Fitted by calibrateConfidence() on test_data/ with the default template store.
+CONFIDENCE_WEIGHTS = (-12.15, 0.772, 1.739)
+
 def dist(p1, p2):
     return math.sqrt((p1[0] - p2[0]) ** 2 + (p1[1] - p2[1]) ** 2)
 
@@ -79,9 +102,7 @@ def getNormalisedCoordinates(x, y, brightest_index, second_brightest_index, line
     return np.array(x), np.array(y), lines
 
 
-def iterateArea(contours, lines=[], iterate=False):
-    lines = np.array(lines)
-
+def getStarCentroids(contours):
     # Finding the coordinates of the contours and their area
     coordinates = {}
     for i in range(len(contours)):
@@ -107,12 +128,25 @@ def iterateArea(contours, lines=[], iterate=False):
         x.append(coordinates[area][0])
         y.append(coordinates[area][1])
 
+    return x, y, sorted_area
+
+
+def countBrightStars(sorted_area):
+    # Number of stars big enough to be tried as reference stars
     threshold = min(150, sorted_area[1])
     # print(sorted_area)
     count = 0
     for area in sorted_area:
         if area >= threshold:
             count += 1
+    return count
+
+
+def iterateArea(contours, lines=[], iterate=False):
+    lines = np.array(lines)
+
+    x, y, sorted_area = getStarCentroids(contours)
+    count = countBrightStars(sorted_area)
 
     coordinates_list = []
     # print(count)
@@ -120,10 +154,7 @@ def iterateArea(contours, lines=[], iterate=False):
         print("end iterateFalse")
         return getNormalisedCoordinates(x, y, 0, 1, lines)
     else:
-        for i in range(count):
-            for j in range(i + 1, count):
-                x_new, y_new, _ = getNormalisedCoordinates(x[i:], y[i:], i, j, lines)
-                coordinates_list.append((x_new, y_new))
+        coordinates_list, _ = pairPermutations(x, y, count)
         print("end")
         return coordinates_list
 
@@ -189,6 +220,7 @@ def getRedChannel(img):
 
 
 def makeTemplates():
+    from matplotlib import pyplot as plt  # Only needed for the debug plots, and slow to import
     # Directory where the templates are stored
     template_directory = "./Templates"
     templates_coordinates = {}
@@ -297,22 +329,121 @@ def makeTemplates():
     with open("Template Coordinates", "wb") as fp:
         pickle.dump(templates_coordinates, fp)
 
-def test_normaliser(test_path):
-    # Process and find the normalised coordinate for each template present in the Templates directory
-    #makeTemplates()
+def catalogTemplateName(constellation, ra_hours):
+    # Serpens is one catalog constellation but two charts: the head lies west of Ophiuchus, the tail east
+    if constellation.strip() == "Serpens":
+        return "SerpensCaput" if ra_hours < 17 else "SerpensCauda"
+    return templateNames(constellation)[0]
 
-    img = cv2.imread(test_path)
-    img = getGrayscale(img)
-    cv2.imshow('test_img', img)
 
-    a = 50
+def gnomonicProjection(ra, dec):
+    # Project RA/Dec (degrees) onto the tangent plane at the constellation's centroid.
+    # Returned in image orientation (x grows to the west, y grows to the south) like the charts.
+    ra = np.radians(np.array(ra, dtype=float))
+    dec = np.radians(np.array(dec, dtype=float))
+
+    # Centroid from the mean unit vector, so constellations crossing RA 0h don't break
+    vx = np.mean(np.cos(dec) * np.cos(ra))
+    vy = np.mean(np.cos(dec) * np.sin(ra))
+    vz = np.mean(np.sin(dec))
+    ra0 = math.atan2(vy, vx)
+    dec0 = math.atan2(vz, math.sqrt(vx ** 2 + vy ** 2))
+
+    cos_c = math.sin(dec0) * np.sin(dec) + math.cos(dec0) * np.cos(dec) * np.cos(ra - ra0)
+    xi = np.cos(dec) * np.sin(ra - ra0) / cos_c
+    eta = (math.cos(dec0) * np.sin(dec) - math.sin(dec0) * np.cos(dec) * np.cos(ra - ra0)) / cos_c
+
+    return list(-xi), list(-eta)
+
+
+def makeCatalogTemplates(catalog_path="stars.csv", output_path="Catalog Template Coordinates", max_stars=12):
+    # Build templates straight from the star catalog instead of the PNG charts in ./Templates.
+    # max_stars keeps the brightest stars only; the default of 12 is about the upper quartile of
+    # the charts (median 7.5 stars), so n_stars stays comparable in the match score.
+    catalog = {}
+    with open(catalog_path, newline='', encoding='utf-8') as fp:
+        for row in csv.DictReader(fp):
+            name = catalogTemplateName(row["constellation"], float(row["ra_hours"]))
+            catalog.setdefault(name, []).append(
+                (float(row["magnitude"]), float(row["ra_degrees"]), float(row["dec_degrees"])))
+
+    templates_coordinates = {}
+    for name, catalog_stars in catalog.items():
+        # Brightest star first, same ordering iterateArea gets from the contour areas
+        catalog_stars.sort()
+        if max_stars is not None:
+            catalog_stars = catalog_stars[:max_stars]
+
+        # Normalisation needs the brightest and second brightest star
+        if len(catalog_stars) < 2:
+            print("Skipping " + name + ": not enough catalog stars")
+            continue
+
+        x, y = gnomonicProjection([s[1] for s in catalog_stars], [s[2] for s in catalog_stars])
+        x, y, normalised_lines = getNormalisedCoordinates(x, y, 0, 1)
+
+        # Same store format as makeTemplates; the catalog has no constellation lines
+        templates_coordinates[name] = [x, y, len(catalog_stars), normalised_lines.reshape(0, 1, 4)]
+
+    with open(output_path, "wb") as fp:
+        pickle.dump(templates_coordinates, fp)
+
+    return templates_coordinates
+
+
+def compareTemplates(catalog_templates, image_templates):
+    # Report how well the catalog-derived templates line up with the image-derived ones.
+    # Both are normalised on their two brightest stars, which therefore always coincide, so those
+    # are left out: agreement is the fraction of the remaining chart stars that have a catalog star
+    # within the matching threshold.
+    report = {}
+    for name in sorted(set(catalog_templates) & set(image_templates)):
+        cat_x, cat_y, cat_stars, _ = catalog_templates[name]
+        img_x, img_y, img_stars, _ = image_templates[name]
+        img_x, img_y = np.array(img_x), np.array(img_y)
+
+        # Skip the chart's reference stars at (0, 0) and (1, 0)
+        others = ~(((np.abs(img_x) < 1e-6) & (np.abs(img_y) < 1e-6)) | ((np.abs(img_x - 1) < 1e-6) & (np.abs(img_y) < 1e-6)))
+        compared = int(np.count_nonzero(others))
+        if compared:
+            matched, error = simillarity_error((img_x[others], img_y[others]), (np.array(cat_x), np.array(cat_y)))
+        else:
+            matched, error = 0, 0
+        report[name] = {
+            "catalog_stars": cat_stars,
+            "image_stars": img_stars,
+            "compared": compared,
+            "matched": matched,
+            "agreement": matched / compared if compared else None,
+            "mean_error": error / matched if matched else None,
+        }
+
+    print("%-22s %8s %8s %8s %10s %10s" % ("constellation", "catalog", "image", "matched", "agreement", "mean_err"))
+    for name, row in report.items():
+        agreement = "-" if row["agreement"] is None else "%.2f" % row["agreement"]
+        mean_error = "-" if row["mean_error"] is None else "%.4f" % row["mean_error"]
+        print("%-22s %8d %8d %4d/%-3d %10s %10s" % (name, row["catalog_stars"], row["image_stars"],
+                                                    row["matched"], row["compared"], agreement, mean_error))
+    scored = [row["agreement"] for row in report.values() if row["agreement"] is not None]
+    if scored:
+        print("Mean agreement: %.2f over %d constellations" % (sum(scored) / len(scored), len(scored)))
+    print("Only in catalog: " + ", ".join(sorted(set(catalog_templates) - set(image_templates))))
+    print("Only in images: " + ", ".join(sorted(set(image_templates) - set(catalog_templates))))
+
+    return report
+
+
+def detectStarContours(img, debug=False):
+    # Finds the star contours in a grayscale photo; debug=True shows the intermediate images
     thresh = binariseImage(img, [190])
     # Subtracting to get only stars
     final = thresh[0]
-    plotImage(final, "final")
+    if debug:
+        plotImage(final, "final")
     # cv2.imwrite("./final.png", final)
     stars = applyMedian(final, 3)
-    plotImage(stars, "stars")
+    if debug:
+        plotImage(stars, "stars")
 
     # stars_grey = getGrayscale(stars)
     # final_stars = binariseImage(stars, [70])
@@ -321,7 +452,8 @@ def test_normaliser(test_path):
     # plotImage(final_stars[0], "final stars")
 
     edged = findEdges(final_stars_inverted, 30, 200)
-    plotImage(edged, "edges")
+    if debug:
+        plotImage(edged, "edges")
 
     edge_copy = edged.copy()
     contours, hierarchy = cv2.findContours(edge_copy, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
@@ -332,9 +464,41 @@ def test_normaliser(test_path):
         if area != 0:
             final_contours.append(contour)
 
-    print("Number of Contours found = " + str(len(final_contours)))
+    return final_contours
+
+
+def decodeImage(data):
+    # Decodes uploaded image bytes straight to a grayscale image, without going through disk.
+    # Returns None for empty or undecodable data (cv2.imdecode raises on an empty buffer).
+    if not data:
+        return None
+    return cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+
+
+def normaliseAroundPair(x, y, first, second):
+    # Normalises the stars with `first` at the origin and `second` at (1, 0).
+    # getNormalisedCoordinates expects the reference star at index 0, so move it to the front.
+    order = [first] + [i for i in range(len(x)) if i != first]
+    x_new, y_new, _ = getNormalisedCoordinates([x[i] for i in order], [y[i] for i in order], 0, order.index(second))
+    return x_new, y_new
+
 
-    coordinates_list = iterateArea(final_contours, [], True)
+def pairPermutations(x, y, count):
+    # Normalised coordinates for every pair (i, j) of the `count` brightest stars, and the pairs.
+    # /upload-photo and the stream tracker both go through here, so their permutations agree.
+    pairs = [(i, j) for i in range(count) for j in range(i + 1, count)]
+    return [normaliseAroundPair(x, y, i, j) for i, j in pairs], pairs
+
+
+def test_normaliser(test_path):
+    # Process and find the normalised coordinate for each template present in the Templates directory
+    #makeTemplates()
+
+    img = cv2.imread(test_path)
+    img = getGrayscale(img)
+    cv2.imshow('test_img', img)
+
+    coordinates_list = normaliseImage(img, debug=True)
     # print(coordinates_list)
 
     # plt.figure("Normalised stars")
@@ -344,6 +508,18 @@ def test_normaliser(test_path):
     return coordinates_list
 
 
+def normaliseImage(img, debug=False):
+    # Normalised coordinates of a grayscale photo for every pair of bright reference stars
+    final_contours = detectStarContours(img, debug)
+
+    print("Number of Contours found = " + str(len(final_contours)))
+
+    # Normalisation needs a pair of reference stars; with fewer there is nothing to match
+    if len(final_contours) < 2:
+        return []
+    return iterateArea(final_contours, [], True)
+
+
 # x, y, _ = iterateArea(final_contours)
 # plt.figure("Normalised stars")
 # plt.scatter(x, y)
@@ -421,6 +597,7 @@ def simillarity_error(train, test):
 
 
 def test_runner(constellation):
+    from matplotlib import pyplot as plt  # Only needed for the debug plots, and slow to import
     #print(constellation)
     test_coordinates = test_normaliser('test_data/' + constellation + '.png')
 
@@ -464,34 +641,131 @@ def test_runner(constellation):
     # print('--------------------'*2 , '\n' , score , pred_label)
     return pred_label
 
-def test_runner_2(path):
-    #print(constellation)
-    test_coordinates = test_normaliser(path)
-
-    file = open('Template Coordinates', 'rb')
-    template_coordinate = pickle.load(file)
-
-    score = -1
-    pred_label = 'None'
-
-    plot_points = []
-
-    for bright_perm, _ in enumerate(test_coordinates):
-        for constellation in template_coordinate:
-            print(constellation)
-            x_template, y_template, n_stars, _ = template_coordinate[constellation]
-            e = simillarity_error((x_template, y_template), test_coordinates[bright_perm])
-            # score(x_test , y_test , x_template , y_template)
+def loadTemplates(path=None, reload=False):
+    # The template store never changes while the server runs, so only unpickle it once.
+    # reload=True reads it again; the cached copy is only replaced if that succeeds.
+    if path is None:
+        path = TEMPLATE_STORE
+    if reload or path not in _template_cache:
+        with open(path, 'rb') as file:
+            _template_cache[path] = pickle.load(file)
+    return _template_cache[path]
+
+
+def templateNames(name):
+    # Map a catalog / client constellation name (e.g. "Ursa Major") to its template names
+    name = name.strip()
+    if name in TEMPLATE_ALIASES:
+        return TEMPLATE_ALIASES[name]
+    return [name.replace(" ", "")]
+
+
+def matchConfidence(score, matched_stars):
+    # Estimated probability that a template match is the photo's constellation, from that
+    # template's own evidence only, so it means the same whether 1 or all templates were scored
+    intercept, per_star, per_log_score = CONFIDENCE_WEIGHTS
+    z = intercept + per_star * matched_stars + per_log_score * math.log(score)
+    return 1 / (1 + math.exp(-z))
+
+
+def rankConstellations(test_coordinates, template_coordinate, k=3, candidates=None):
+    # Single pass over the templates keeping a bounded min-heap of the k best
+    # (score, constellation, bright_perm) entries, so alternatives come for free.
+    #
+    # Each result carries:
+    #   confidence       - calibrated probability that this is the right constellation (matchConfidence)
+    #   score_share      - the template's share of the summed scores of every template that matched
+    #                      at all. Only meaningful relative to the other candidates; 1.0 when one
+    #                      template is scored
+    #   matched_fraction - fraction of the template's stars found in the photo, not counting the
+    #                      two reference stars that normalisation always puts on top of each other
+    if candidates is None:
+        candidates = template_coordinate.keys()
+
+    heap = []
+    total = 0.0
+    for constellation in candidates:
+        if constellation not in template_coordinate:
+            continue
+        x_template, y_template, n_stars, _ = template_coordinate[constellation]
+
+        # Best brightness permutation of the photo for this template
+        best = None
+        for bright_perm, coordinates in enumerate(test_coordinates):
+            e = simillarity_error((x_template, y_template), coordinates)
             cur_score = e[0] * (e[0] - 2) / (n_stars * e[1])
-            # cur_score = np.exp(e[0] / n_stars) * (e[0]-2) / e[1]
-            # print(constellation , e , n_stars , cur_score)
+            if e[0] > 2 and cur_score < 1e+3 and (best is None or cur_score > best[0]):
+                best = (cur_score, bright_perm, e[0])
+
+        if best is None:
+            continue
+        total += best[0]
+
+        entry = (best[0], constellation, best[1], best[2], n_stars)
+        if len(heap) < k:
+            heapq.heappush(heap, entry)
+        elif entry[0] > heap[0][0]:
+            heapq.heapreplace(heap, entry)
+
+    ranked = []
+    for cur_score, constellation, bright_perm, matched, n_stars in sorted(heap, reverse=True):
+        ranked.append({
+            "constellation": constellation,
+            "score": float(cur_score),
+            "confidence": matchConfidence(cur_score, max(0, matched - 2)),
+            "score_share": float(cur_score / total),
+            "matched_fraction": max(0, matched - 2) / max(1, n_stars - 2),
+            "permutation": bright_perm,
+        })
+    return ranked
+
+
+def test_runner_topk(path, k=3, candidates=None):
+    # Returns up to k ranked matches for the photo, best first.
+    # Pass candidates (template names) to only score those templates.
+    test_coordinates = test_normaliser(path)
+    template_coordinate = loadTemplates()
+    return rankConstellations(test_coordinates, template_coordinate, k, candidates)
+
+
+def rankImage(img, k=3, candidates=None):
+    # Same as test_runner_topk for an already decoded grayscale image, without the debug windows
+    return rankConstellations(normaliseImage(img), loadTemplates(), k, candidates)
+
+
+def calibrateConfidence(directory='test_data'):
+    # Refits CONFIDENCE_WEIGHTS: scores every template against every photo in directory (named
+    # <template>.png) and fits a logistic regression of "is the right template" on the evidence
+    template_coordinate = loadTemplates()
+    features, labels = [], []
+    for file in sorted(os.listdir(directory)):
+        name, ext = os.path.splitext(file)
+        if ext != '.png':
+            continue
+        img = cv2.imread(os.path.join(directory, file), cv2.IMREAD_GRAYSCALE)
+        for result in rankImage(img, len(template_coordinate)):
+            n_stars = template_coordinate[result["constellation"]][2]
+            matched_stars = round(result["matched_fraction"] * max(1, n_stars - 2))
+            features.append((1.0, matched_stars, math.log(result["score"])))
+            labels.append(float(result["constellation"] == name))
+
+    # Newton's method, with a little ridge so a perfectly separable set still converges
+    X, y = np.array(features), np.array(labels)
+    w = np.zeros(X.shape[1])
+    for _ in range(100):
+        p = 1 / (1 + np.exp(-X @ w))
+        hessian = (X * (p * (1 - p))[:, None]).T @ X + 1e-3 * np.eye(len(w))
+        w += np.linalg.solve(hessian, X.T @ (y - p))
+
+    print("CONFIDENCE_WEIGHTS = (%.3f, %.3f, %.3f) from %d matches, %d of them correct" % (w[0], w[1], w[2], len(y), int(y.sum())))
+    return tuple(float(v) for v in w)
 
-            if e[0] > 2 and score < cur_score < 1e+3:
-                pred_label = constellation
-                score = cur_score
 
-    # print('--------------------'*2 , '\n' , score , pred_label)
-    return pred_label
+def test_runner_2(path):
+    ranked = test_runner_topk(path, k=1)
+    if not ranked:
+        return 'None'
+    return ranked[0]["constellation"]
 
 
 if __name__ == "__main__":
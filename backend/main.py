@@ -1,31 +1,182 @@
 # Import necessary libraries
-from flask import Flask, request, jsonify  # Flask for creating the web app and handling requests
+from flask import Flask, request, jsonify, send_file  # Flask for creating the web app and handling requests
 from flask_cors import CORS  # To handle Cross-Origin Resource Sharing
 
+import math
 import os
+import pickle
+import re
+import sys
+import threading
+import time
+import uuid
 
-from httpx import ConnectError
+from profiler import profiled, profile_path, authorized, list_profiles  # Opt-in per-request cProfile hook
 
-import cvmodel
+import dateutil.parser  # Date utilities for date parsing
 
- # Importing Skyfield functions for astronomical calculations
-from skyfield.api import load, N, W, wgs84, Star, Angle 
+# Heavy dependencies (pandas, Skyfield, OpenCV via cvmodel) and data (catalog, ephemeris,
+# templates) are loaded on first use, or all at once by warmup(), to keep cold starts fast.
+# See bench_importtime.py.
 
-import pandas as pd  # For data manipulation and analysis
+# Star data from stars.csv as a pandas DataFrame, loaded by get_stars()
+stars = None
 
-from random import choice  # For selecting a random constellation
-import dateutil  # Date utilities for date parsing
-
-# Load star data from a CSV file into a pandas DataFrame
-stars = pd.read_csv("stars.csv")
+# Function to load the star data from a CSV file into a pandas DataFrame on first use
+def get_stars():
+    global stars
+    if stars is None:
+        import pandas as pd  # For data manipulation and analysis
+        stars = pd.read_csv("stars.csv")
+    return stars
 
 # Function to create a Star object given right ascension (ra) and declination (dec)
 def get_star(ra, dec):
+    from skyfield.api import Star, Angle  # Importing Skyfield functions for astronomical calculations
     return Star(ra=Angle(degrees=ra), dec=Angle(degrees=dec))  # Return a Star object with specified ra and dec
 
+# Ephemeris and timescale are loaded once per process (or once in the parent before forking workers)
+planets = None
+timescale = None
+star_index = None
+ready = False  # Set once warmup() has loaded everything
+preload = False  # Set by create_app(): readiness then waits for warmup() instead of loading lazily
+
+# Function to load the JPL ephemeris DE421 on first use
+def get_planets():
+    global planets
+    if planets is None:
+        from skyfield.api import load
+        planets = load("de421.bsp")
+    return planets
+
+# Function to load the timescale data on first use
+def get_timescale():
+    global timescale
+    if timescale is None:
+        from skyfield.api import load
+        timescale = load.timescale()
+    return timescale
+
+# Function to load the star catalog, ephemeris and template store up front.
+# With reload=True everything is read again from disk (used for graceful reloads); if that
+# raises, the data already loaded stays in use.
+def warmup(reload=False):
+    global stars, planets, timescale, star_index, ready
+    import cvmodel
+    import tracking  # Imported here so the first streamed frame doesn't pay for it
+    if reload:
+        # Load everything into temporaries first, so a failure leaves the current data in place
+        import pandas as pd
+        from skyfield.api import load
+        from skyindex import SkyIndex
+        new_stars = pd.read_csv("stars.csv")
+        new_planets = load("de421.bsp")
+        new_timescale = load.timescale()
+        new_index = SkyIndex.from_dataframe(new_stars)
+        cvmodel.loadTemplates(reload=True)
+        stars, planets, timescale, star_index = new_stars, new_planets, new_timescale, new_index
+    get_stars()
+    get_planets()
+    get_timescale()
+    get_star_index()
+    cvmodel.loadTemplates()
+    ready = True
+
+# Function to create the observer location and time for the given coordinates and UTC timestamp.
+# Latitude is north-positive and longitude east-positive, as browser geolocation reports them.
+def get_observer(lat, lng, timestamp):
+    from skyfield.api import wgs84
+    earth = get_planets()["earth"]
+
+    ts = get_timescale().utc(dateutil.parser.parse(timestamp))  # Create a timescale object with the given timestamp
+    loc = earth + wgs84.latlon(lat, lng)  # Create a location object using the latitude and longitude
+    return loc, ts
+
+# Function to build (once) the spatial index over the catalog's RA/Dec
+def get_star_index():
+    global star_index
+    if star_index is None:
+        from skyindex import SkyIndex  # Declination band / RA bin index over the catalog
+        star_index = SkyIndex.from_dataframe(get_stars())
+    return star_index
+
+# Function to find the constellations with at least one star above min_alt degrees,
+# optionally only counting stars at least as bright as max_magnitude
+def get_visible_constellations(loc, ts, min_alt, max_magnitude=None):
+    observer = loc.at(ts)
+
+    # The zenith in catalog (ICRS) coordinates; only stars near it can be above min_alt
+    zenith_ra, zenith_dec, _ = observer.from_altaz(alt_degrees=90, az_degrees=0).radec()
+    candidates = get_star_index().above_altitude(zenith_ra.hours * 15, zenith_dec.degrees, min_alt, max_magnitude)
+    if len(candidates) == 0:
+        return []
+
+    # Exact altitude for the candidate stars only, observed together as one vector Star
+    df = get_stars().iloc[candidates]
+    alt, az, d = observer.observe(get_star(df["ra_degrees"].values, df["dec_degrees"].values)).apparent().altaz()
+
+    visibleConstellations = []  # Initialize a list to store visible constellations
+    for constellation, above in zip(df["constellation"], alt.degrees > min_alt):
+        # Check if the star is above the minimum altitude and not already in the list
+        if above and constellation not in visibleConstellations:
+            visibleConstellations.append(constellation)  # Add the constellation to the list
+
+    return visibleConstellations
+
+# Degrees below the horizon a constellation's stars may sit and still be matched, so constellations
+# right on the horizon (low stars, refraction, a slightly wrong clock) aren't pruned
+HORIZON_MARGIN = 5
+
+# Function to restrict the templates to constellations above the horizon for the observer
+def get_visible_templates(loc, ts):
+    import cvmodel
+    visible = set()
+    for c in get_visible_constellations(loc, ts, -HORIZON_MARGIN):
+        visible.update(cvmodel.templateNames(c))
+
+    # Templates without any catalog stars (e.g. Mensa) can't be ruled out, so keep them
+    catalogued = set()
+    for c in get_stars()["constellation"].unique():
+        catalogued.update(cvmodel.templateNames(c))
+
+    return [t for t in cvmodel.loadTemplates() if t in visible or t not in catalogued]
+
 # Initialize the Flask application
 app = Flask(__name__)
-CORS(app)  # Allow CORS requests from React frontend
+# Allow CORS requests from React frontend, and let it read the profiling headers
+CORS(app, expose_headers=["X-Profile-Id", "X-Request-Id"])
+
+
+# App factory for production serving: loads all shared data before the app handles requests
+def create_app(warm=True):
+    global preload
+    if warm:
+        preload = True
+        warmup()
+    return app
+
+
+# Liveness probe: the process is up and serving requests
+@app.route("/healthz", methods=["GET"])
+def healthz():
+    return jsonify({"status": "ok", "pid": os.getpid()})
+
+
+# Readiness probe: with preloading, ready once the catalog, ephemeris and templates are loaded;
+# otherwise (e.g. python main.py) always ready, since everything loads on first use
+@app.route("/readyz", methods=["GET"])
+def readyz():
+    loaded = {
+        "stars": stars is not None,
+        "ephemeris": planets is not None,
+        "timescale": timescale is not None,
+        "star_index": star_index is not None,
+        "templates": "cvmodel" in sys.modules and bool(sys.modules["cvmodel"]._template_cache),
+    }
+    if preload and not ready:
+        return jsonify({"status": "loading", "mode": "preload", "loaded": loaded, "pid": os.getpid()}), 503
+    return jsonify({"status": "ready", "mode": "preload" if preload else "lazy", "loaded": loaded, "pid": os.getpid()})
 
 
 # Route to receive location data
@@ -50,36 +201,31 @@ def receive_location():
 
 # Route to receive visibility data
 @app.route("/visible", methods=["POST"])
+@profiled
 def receive_visible():
     data = request.get_json()  # Get the JSON data sent in the request
     lat = data.get("latitude")  # Extract latitude from the data
     lng = data.get("longitude")  # Extract longitude from the data
     timestamp = data.get("timestamp")  # Retrieve the timestamp (UTC)
+    max_magnitude = data.get("max_magnitude")  # Optional faintest magnitude to consider
+    if max_magnitude is not None:
+        try:
+            max_magnitude = float(max_magnitude)
+        except (TypeError, ValueError):
+            max_magnitude = math.nan
+        # NaN would compare false everywhere and quietly mean "no limit"
+        if not math.isfinite(max_magnitude):
+            return jsonify({"error": "max_magnitude must be a finite number"}), 400
+
+    loc, ts = get_observer(lat, lng, timestamp)  # Observer location and time
 
-    planets = load("de421.bsp")  # Load the JPL ephemeris DE421
-    earth = planets["earth"]
-
-    ts = load.timescale().utc(dateutil.parser.parse(timestamp))  # Create a timescale object with the given timestamp
-    loc = earth + wgs84.latlon(lat * N, lng * W)  # Create a location object using the latitude and longitude
-
-    visibleConstellations = []  # Initialize a list to store visible constellations
     print(f"Received coordinates: Latitude={lat}, Longitude={lng}, Time={timestamp}")  # Log the received coordinates and timestamp
 
-    # Loop through each star in the stars DataFrame
-    for star in stars.iterrows():
-
-        star = star[1]
-        # Observe the star's position from the observer's location at the given time
-        starPos = loc.at(ts).observe(get_star(star["ra_degrees"], star["dec_degrees"]))
-
-        # Get the altitude and azimuth of the star
-        alt, az, d = starPos.apparent().altaz()
-
-        # Check if the star is above 45 degrees altitude and not already in the list
-        if alt.degrees > 45 and star["constellation"] not in visibleConstellations:
-            visibleConstellations.append(star["constellation"])  # Add the constellation to the list
+    # Constellations with at least one star above 45 degrees altitude
+    visibleConstellations = get_visible_constellations(loc, ts, 45, max_magnitude)
 
     consts = []
+    stars = get_stars()
     
     for c in visibleConstellations:
         # Find the guide star with the minimum magnitude in the chosen constellation
@@ -110,38 +256,203 @@ def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in {'jpg', 'jpeg', 'png'}
 
 @app.route('/upload-photo', methods=['POST'])
+@profiled
 def upload_photo():
+    import cvmodel
     if 'photo' not in request.files:
         return jsonify({"error": "No file part"}), 400
     
     file = request.files['photo']
 
     constellation = request.form.get('constellation')
+
+    # How many ranked alternatives to return, and whether to only check the expected constellation
+    try:
+        top_k = int(request.form.get('top_k', 3))
+    except ValueError:
+        return jsonify({"error": "top_k must be an integer"}), 400
+    if top_k < 1:
+        return jsonify({"error": "top_k must be at least 1"}), 400
+    only_expected = request.form.get('only_expected', 'false').lower() in {'1', 'true', 'yes'}
+
+    expected = cvmodel.templateNames(constellation) if constellation else []
+    if only_expected and not expected:
+        return jsonify({"error": "only_expected requires a constellation"}), 400
+
+    # Optional observer location/time, used to skip constellations below the horizon
+    latitude = request.form.get('latitude')
+    longitude = request.form.get('longitude')
+    timestamp = request.form.get('timestamp')
+    observer = None
+    if latitude is not None and longitude is not None and timestamp is not None:
+        try:
+            latitude, longitude = float(latitude), float(longitude)
+            # float() also accepts "nan"/"inf", which would silently filter out every constellation
+            if not (math.isfinite(latitude) and math.isfinite(longitude)
+                    and abs(latitude) <= 90 and abs(longitude) <= 180):
+                raise ValueError("latitude or longitude out of range")
+            observer = get_observer(latitude, longitude, timestamp)
+        except (ValueError, OverflowError):
+            return jsonify({"error": "Invalid latitude, longitude or timestamp"}), 400
+
     file.filename += '.jpg'    
     # Save or process the file
     if file and allowed_file(file.filename):  # Optionally, validate file type
-        file.save(os.path.join("uploads", file.filename))  # Save file if needed
-        # Process the image as needed here, e.g., with OpenCV or PIL
-
-        path = "./uploads/blob.jpg"
-        result = cvmodel.test_runner_2(path)
-        if result is None:
-            match = False
-        else:
-            match = (result == constellation)
+        # Decode the upload in memory: a shared file under uploads/ would let concurrent
+        # requests (e.g. from different serve.py workers) score each other's photo
+        data = file.read()
+        img = cvmodel.decodeImage(data) if data else None
+        if img is None:
+            return jsonify({"error": "Invalid file"}), 400
+
+        # Skip scoring every other template when the client only wants to verify its guess
+        candidates = expected if only_expected else None
+
+        # Skip templates that are below the horizon when the client sent its location and time
+        if observer is not None:
+            visible = get_visible_templates(*observer)
+            if candidates is None:
+                candidates = visible
+            else:
+                candidates = [t for t in candidates if t in visible]
+
+        ranked = cvmodel.rankImage(img, top_k, candidates)
+
+        result = ranked[0]["constellation"] if ranked else None
+        match = result is not None and result in expected
         print(result, constellation, match)
         # Return success message or analysis results
         return jsonify({
             "message": "File uploaded successfully", 
-            "matched_constellation": match})
+            "matched_constellation": match,
+            "predicted_constellation": result,
+            "candidates": ranked})
     else:
         return jsonify({"error": "Invalid file"}), 400
 
 
+# Streaming recognition sessions. Each session's StarTracker is pickled to STREAM_DIR/<id>.pkl
+# and locked while a request uses it, so consecutive requests may land on any serve.py worker
+# (or dev server thread) and still continue the same track.
+STREAM_DIR = os.environ.get("STREAM_DIR", "streams")
+STREAM_IDLE_SECONDS = 300
+STREAM_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+try:
+    import fcntl  # Locks a session file across worker processes and threads
+except ImportError:  # Windows: only the single-process dev server runs there
+    fcntl = None
+stream_lock = threading.Lock()
+
+# Function to get the file holding a session's tracker, or None for a malformed id
+def stream_path(session_id):
+    if not STREAM_ID_PATTERN.match(session_id):
+        return None
+    return os.path.join(STREAM_DIR, session_id + ".pkl")
+
+# Function to drop streaming sessions that stopped sending frames
+def expire_stream_sessions():
+    now = time.time()
+    for name in os.listdir(STREAM_DIR):
+        path = os.path.join(STREAM_DIR, name)
+        try:
+            if now - os.path.getmtime(path) > STREAM_IDLE_SECONDS:
+                os.remove(path)
+        except OSError:
+            pass  # Already removed by another worker
+
+# Route to start a streaming recognition session
+@app.route('/stream', methods=['POST'])
+def start_stream():
+    from tracking import StarTracker  # Frame-to-frame star tracking for streamed recognition
+    os.makedirs(STREAM_DIR, exist_ok=True)
+    expire_stream_sessions()
+    session_id = uuid.uuid4().hex
+    with open(stream_path(session_id), "wb") as fp:
+        pickle.dump(StarTracker(), fp)
+    return jsonify({"session_id": session_id})
+
+# Route to send one or more consecutive frames (multipart field 'photo', in order) of a session
+@app.route('/stream/<session_id>/frames', methods=['POST'])
+@profiled
+def stream_frames(session_id):
+    import cvmodel
+    frames = request.files.getlist('photo')
+    if not frames:
+        return jsonify({"error": "No file part"}), 400
+
+    path = stream_path(session_id)
+    try:
+        fp = open(path, "r+b") if path is not None else None
+    except FileNotFoundError:
+        fp = None
+    if fp is None:
+        return jsonify({"error": "Unknown or expired session"}), 404
+
+    # One request at a time per session; the tracker is read, advanced and written back under the lock
+    with fp:
+        if fcntl is not None:
+            fcntl.flock(fp, fcntl.LOCK_EX)
+        else:
+            stream_lock.acquire()
+        try:
+            tracker = pickle.load(fp)
+            results = []
+            error = None
+            for frame in frames:
+                img = cvmodel.decodeImage(frame.read())
+                if img is None:
+                    error = "Invalid frame"
+                    break
+                results.append(tracker.process(img))
+
+            # Save the frames processed so far, even when a later one was invalid
+            fp.seek(0)
+            fp.truncate()
+            pickle.dump(tracker, fp)
+        finally:
+            if fcntl is None:
+                stream_lock.release()
+
+    if error is not None:
+        return jsonify({"error": error, "results": results}), 400
+    return jsonify({"session_id": session_id, "results": results})
+
+# Route to end a streaming recognition session
+@app.route('/stream/<session_id>', methods=['DELETE'])
+def stop_stream(session_id):
+    path = stream_path(session_id)
+    try:
+        if path is not None:
+            os.remove(path)
+    except FileNotFoundError:
+        pass
+    return jsonify({"message": "Stream closed"})
+
+
+# Route to list the stored profiles (endpoint, client request id, duration), optionally for one request id
+@app.route('/profiles', methods=['GET'])
+def get_profiles():
+    if not authorized():
+        return jsonify({"error": "Invalid profile token"}), 403
+    return jsonify(list_profiles(request.args.get("request_id")))
+
+
+# Route to download the cProfile stats captured for a profiled request
+@app.route('/profiles/<profile_id>', methods=['GET'])
+def download_profile(profile_id):
+    if not authorized():
+        return jsonify({"error": "Invalid profile token"}), 403
+    path = profile_path(profile_id)
+    if path is None or not os.path.isfile(path):
+        return jsonify({"error": "Profile not found"}), 404
+    return send_file(os.path.abspath(path), mimetype="application/octet-stream",
+                     as_attachment=True, download_name=profile_id + ".prof")
+
 
 # Main entry point for the application
 if __name__ == "__main__":
-    stars = pd.read_csv("stars.csv")  # Load the star data again before starting the app
+    get_stars()  # Load the star data before starting the app
     app.run(debug=True, ssl_context='adhoc')  # Run the Flask app in debug mode
 
 
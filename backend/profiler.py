@@ -0,0 +1,151 @@
+import cProfile
+import hmac
+import json
+import os
+import random
+import re
+import time
+import uuid
+from functools import wraps
+
+from flask import request, make_response
+
+# Directory where the per-request profiles are written
+PROFILE_DIR = os.environ.get("PROFILE_DIR", "profiles")
+
+# Send this header (any value other than "0") to force profiling of a single request
+PROFILE_HEADER = "X-Profile"
+
+# Fraction of requests (0.0 - 1.0) that get profiled even without the header
+PROFILE_SAMPLE_RATE = float(os.environ.get("PROFILE_SAMPLE_RATE", "0"))
+
+# When set, the X-Profile header, /profiles listings and /profiles/<id> downloads need a matching X-Profile-Token header
+PROFILE_TOKEN = os.environ.get("PROFILE_TOKEN")
+
+# Retention: keep at most this many profiles, none older than this many seconds
+PROFILE_MAX_FILES = int(os.environ.get("PROFILE_MAX_FILES", "200"))
+PROFILE_MAX_AGE = float(os.environ.get("PROFILE_MAX_AGE", str(7 * 24 * 3600)))
+
+# Client request ids are only echoed back, so just keep them to a sane header value
+REQUEST_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{1,64}$")
+
+# Profile ids are always generated here (uuid4 hex) and used as file names
+PROFILE_ID_PATTERN = re.compile(r"^[0-9a-f]{32}$")
+
+
+def authorized():
+    # True if no token is configured or the request carries the right one
+    if not PROFILE_TOKEN:
+        return True
+    return hmac.compare_digest(request.headers.get("X-Profile-Token", ""), PROFILE_TOKEN)
+
+
+def should_profile():
+    # Explicit opt-in through the header always wins
+    flag = request.headers.get(PROFILE_HEADER)
+    if flag is not None:
+        return flag != "0" and authorized()
+    return PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE
+
+
+def profile_path(profile_id):
+    # Returns the .prof file for a profile id, or None if the id is not valid
+    if not PROFILE_ID_PATTERN.match(profile_id):
+        return None
+    return os.path.join(PROFILE_DIR, profile_id + ".prof")
+
+
+def record_path(profile_id):
+    # Sidecar JSON describing which request a profile came from
+    return os.path.join(PROFILE_DIR, profile_id + ".json")
+
+
+def list_profiles(request_id=None):
+    # Records of the stored profiles, newest first, optionally only those for one client request id
+    records = []
+    for name in os.listdir(PROFILE_DIR) if os.path.isdir(PROFILE_DIR) else []:
+        if not name.endswith(".json"):
+            continue
+        try:
+            with open(os.path.join(PROFILE_DIR, name)) as fp:
+                record = json.load(fp)
+        except (OSError, ValueError):
+            continue  # Pruned or still being written by another worker
+        if request_id is None or record.get("request_id") == request_id:
+            records.append(record)
+    records.sort(key=lambda record: record["started_at"], reverse=True)
+    return records
+
+
+def prune_profiles():
+    # Drop profiles past PROFILE_MAX_AGE, then the oldest ones beyond PROFILE_MAX_FILES
+    profiles = []
+    for name in os.listdir(PROFILE_DIR):
+        if not name.endswith(".prof"):
+            continue
+        path = os.path.join(PROFILE_DIR, name)
+        try:
+            profiles.append((os.path.getmtime(path), name[:-len(".prof")]))
+        except OSError:
+            continue  # Removed by another worker in the meantime
+    profiles.sort(reverse=True)
+
+    now = time.time()
+    for i, (mtime, profile_id) in enumerate(profiles):
+        if i >= PROFILE_MAX_FILES or now - mtime > PROFILE_MAX_AGE:
+            for path in (profile_path(profile_id), record_path(profile_id)):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+
+def profiled(view):
+    # Decorator for Flask views: runs the view under cProfile when requested or sampled
+    # and stores the stats as <PROFILE_DIR>/<profile id>.prof (open with snakeviz/flameprof)
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # Echo the client's request id so it can correlate its logs with ours
+        client_id = request.headers.get("X-Request-Id", "")
+
+        if not should_profile():
+            response = make_response(view(*args, **kwargs))
+        else:
+            profile_id = uuid.uuid4().hex
+            started_at = time.time()
+            status = 500  # Unless the view returns a response
+            profile = cProfile.Profile()
+            profile.enable()
+            try:
+                response = make_response(view(*args, **kwargs))
+                status = response.status_code
+            finally:
+                profile.disable()
+                duration_ms = (time.time() - started_at) * 1000
+                os.makedirs(PROFILE_DIR, exist_ok=True)
+                profile.dump_stats(profile_path(profile_id))
+
+                # Record which request the profile belongs to, so sampled profiles can be found later
+                record = {
+                    "profile_id": profile_id,
+                    "path": profile_path(profile_id),
+                    "endpoint": request.endpoint,
+                    "method": request.method,
+                    "url": request.path,
+                    "request_id": client_id if REQUEST_ID_PATTERN.match(client_id) else None,
+                    "status": status,
+                    "started_at": started_at,
+                    "duration_ms": round(duration_ms, 3),
+                }
+                with open(record_path(profile_id), "w") as fp:
+                    json.dump(record, fp)
+                print(f"Profiled {request.method} {request.path} request_id={record['request_id']} "
+                      f"profile_id={profile_id} duration={duration_ms:.1f}ms")
+                prune_profiles()
+            response.headers["X-Profile-Id"] = profile_id  # Tells the client a profile is available
+
+        if REQUEST_ID_PATTERN.match(client_id):
+            response.headers["X-Request-Id"] = client_id
+        return response
+
+    return wrapper
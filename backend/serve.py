@@ -0,0 +1,166 @@
+# Production entry point: pre-forking server for the Flask app in main.py
+#
+# The parent loads the star catalog, ephemeris and template store once, then forks
+# N workers that share that data copy-on-write and accept on the same listening socket.
+#
+#   python serve.py --host 0.0.0.0 --port 8000 --workers 4
+#
+# SIGHUP reloads the data and replaces the workers gracefully, SIGTERM/SIGINT shut down.
+
+import argparse
+import gc
+import os
+import signal
+import socket
+import threading
+import time
+import traceback
+
+from werkzeug.serving import make_server
+
+import main
+
+
+def bind_socket(host, port, backlog=128):
+    # One listening socket, created in the parent and inherited by every worker
+    family = socket.AF_INET6 if ":" in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.set_inheritable(True)
+    return sock
+
+
+def run_worker(app, sock, host, port, ssl_context):
+    server = make_server(host, port, app, ssl_context=ssl_context, fd=sock.fileno())
+
+    # Finish the request in flight, then stop (shutdown() has to run off the serving thread)
+    def stop(signum, frame):
+        threading.Thread(target=server.shutdown, daemon=True).start()
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # Ctrl+C is handled by the parent
+    signal.signal(signal.SIGHUP, signal.SIG_IGN)
+    server.serve_forever()
+
+
+class Arbiter:
+    # Keeps `workers` children alive and handles reload/shutdown signals
+
+    def __init__(self, app, sock, host, port, workers, ssl_context=None):
+        self.app = app
+        self.sock = sock
+        self.host = host
+        self.port = port
+        self.num_workers = workers
+        self.ssl_context = ssl_context
+        self.workers = set()
+        self.running = True
+        self.reload_requested = False
+
+    def spawn(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                run_worker(self.app, self.sock, self.host, self.port, self.ssl_context)
+            except BaseException:
+                traceback.print_exc()
+                os._exit(1)
+            os._exit(0)
+        self.workers.add(pid)
+        return pid
+
+    def prefork(self):
+        # Move everything loaded so far out of the GC's reach, so collections in the
+        # workers don't write to (and un-share) the pages holding the catalog and templates
+        gc.collect()
+        gc.freeze()
+        while len(self.workers) < self.num_workers:
+            self.spawn()
+
+    def stop_workers(self, pids, sig=signal.SIGTERM):
+        for pid in pids:
+            try:
+                os.kill(pid, sig)
+            except ProcessLookupError:
+                self.workers.discard(pid)
+
+    def reap(self):
+        # Collect exited workers without blocking
+        while True:
+            try:
+                pid, _ = os.waitpid(-1, os.WNOHANG)
+            except ChildProcessError:
+                return
+            if pid == 0:
+                return
+            if pid in self.workers:
+                self.workers.discard(pid)
+                if self.running:
+                    print(f"Worker {pid} exited")
+
+    def reload(self):
+        # Load fresh data, start a new generation of workers, then retire the old one.
+        # If loading fails the current workers (and the parent's data) are kept as they are.
+        print("Reloading catalog, ephemeris and templates")
+        try:
+            main.warmup(reload=True)
+        except Exception:
+            traceback.print_exc()
+            print("Reload failed, keeping the current workers")
+            return
+        gc.unfreeze()  # Let the replaced data be collected before freezing the new generation
+        old_workers = set(self.workers)
+        self.workers = set()
+        self.prefork()
+        self.stop_workers(old_workers)
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self.handle_stop)
+        signal.signal(signal.SIGINT, self.handle_stop)
+        signal.signal(signal.SIGHUP, self.handle_reload)
+
+        self.prefork()
+        print(f"Serving on {self.host}:{self.port} with {self.num_workers} workers (parent pid {os.getpid()})")
+
+        while self.running:
+            if self.reload_requested:
+                self.reload_requested = False
+                self.reload()
+            self.reap()
+            # Replace workers that died; the short sleep keeps a crashing worker from fork-looping
+            if self.running and len(self.workers) < self.num_workers:
+                self.prefork()
+            time.sleep(0.5)
+
+        # Graceful shutdown: let workers finish their current request
+        self.stop_workers(set(self.workers))
+        deadline = time.time() + 30
+        while self.workers and time.time() < deadline:
+            self.reap()
+            time.sleep(0.1)
+        self.stop_workers(set(self.workers), signal.SIGKILL)
+        self.sock.close()
+
+    def handle_stop(self, signum, frame):
+        self.running = False
+
+    def handle_reload(self, signum, frame):
+        self.reload_requested = True
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="Pre-forking production server for the backend")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1)
+    parser.add_argument("--adhoc-ssl", action="store_true", help="serve HTTPS with a self-signed certificate, like the dev server")
+    return parser.parse_args()
+
+
+if __name__ == "__main__":
+    args = parse_args()
+    app = main.create_app()  # Loads the shared data once, before forking
+    sock = bind_socket(args.host, args.port)
+    Arbiter(app, sock, args.host, args.port, args.workers, "adhoc" if args.adhoc_ssl else None).run()
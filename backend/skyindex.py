@@ -0,0 +1,85 @@
+import math
+
+import numpy as np
+
+
+# Extra radius (degrees) added to every altitude query, so stars that aberration, proper motion
+# or precession (if the zenith is given for the date rather than in ICRS) push over the edge are kept
+CAP_MARGIN = 1.0
+
+
+class SkyIndex:
+    # Spatial index over catalog RA/Dec: declination bands split into RA bins.
+    # Each cell keeps its star indices sorted by magnitude, so magnitude limits are a cut.
+
+    def __init__(self, ra_degrees, dec_degrees, magnitudes, band_height=5.0, ra_bins=72):
+        self.ra = np.asarray(ra_degrees, dtype=float) % 360
+        self.dec = np.asarray(dec_degrees, dtype=float)
+        self.magnitude = np.asarray(magnitudes, dtype=float)
+        self.band_height = band_height
+        self.n_bands = int(math.ceil(180 / band_height))
+        self.ra_bins = ra_bins
+        self.bin_width = 360 / ra_bins
+
+        bands = np.minimum(((self.dec + 90) // band_height).astype(int), self.n_bands - 1)
+        bins = (self.ra // self.bin_width).astype(int) % ra_bins
+
+        self.cells = {}
+        for band, ra_bin in set(zip(bands.tolist(), bins.tolist())):
+            members = np.nonzero((bands == band) & (bins == ra_bin))[0]
+            self.cells[(band, ra_bin)] = members[np.argsort(self.magnitude[members], kind="stable")]
+
+    @classmethod
+    def from_dataframe(cls, df, **kwargs):
+        return cls(df["ra_degrees"].values, df["dec_degrees"].values, df["magnitude"].values, **kwargs)
+
+    def band_range(self, dec_lo, dec_hi):
+        lo = int((max(dec_lo, -90) + 90) // self.band_height)
+        hi = int((min(dec_hi, 90) + 90) // self.band_height)
+        return range(max(lo, 0), min(hi, self.n_bands - 1) + 1)
+
+    def bin_range(self, ra_lo, ra_hi):
+        # RA bins covering [ra_lo, ra_hi], wrapping around 0h
+        if ra_hi - ra_lo >= 360:
+            return range(self.ra_bins)
+        first = int(math.floor(ra_lo / self.bin_width))
+        last = int(math.floor(ra_hi / self.bin_width))
+        return sorted({b % self.ra_bins for b in range(first, last + 1)})
+
+    def cap(self, ra0, dec0, radius, max_magnitude=None):
+        # Indices (ascending) of the stars within `radius` degrees of (ra0, dec0),
+        # optionally only those at least as bright as max_magnitude
+        radius = min(radius, 180)
+        dec_lo = dec0 - radius
+        dec_hi = dec0 + radius
+
+        # RA half-width of the cap; every RA is possible once the cap reaches a pole
+        if dec_hi >= 90 or dec_lo <= -90:
+            half_width = 180
+        else:
+            half_width = math.degrees(math.asin(min(1, math.sin(math.radians(radius)) / math.cos(math.radians(dec0)))))
+
+        chunks = []
+        for band in self.band_range(dec_lo, dec_hi):
+            for ra_bin in self.bin_range(ra0 - half_width, ra0 + half_width):
+                members = self.cells.get((band, ra_bin))
+                if members is None:
+                    continue
+                if max_magnitude is not None:
+                    members = members[:np.searchsorted(self.magnitude[members], max_magnitude, side="right")]
+                chunks.append(members)
+
+        if not chunks:
+            return np.array([], dtype=int)
+        candidates = np.sort(np.concatenate(chunks))
+
+        # Cheap angular-distance check on the survivors of the cell lookup
+        ra = np.radians(self.ra[candidates])
+        dec = np.radians(self.dec[candidates])
+        cos_dist = (math.sin(math.radians(dec0)) * np.sin(dec)
+                    + math.cos(math.radians(dec0)) * np.cos(dec) * np.cos(ra - math.radians(ra0)))
+        return candidates[cos_dist >= math.cos(math.radians(radius))]
+
+    def above_altitude(self, zenith_ra, zenith_dec, min_alt, max_magnitude=None):
+        # Stars that could be above min_alt for an observer whose zenith is at (zenith_ra, zenith_dec)
+        return self.cap(zenith_ra, zenith_dec, 90 - min_alt + CAP_MARGIN, max_magnitude)
@@ -0,0 +1,119 @@
+import numpy as np
+
+import cvmodel
+
+
+class StarTracker:
+    # Recognises a stream of frames from one camera pan.
+    #
+    # Each frame's star centroids are matched to the previous frame's. While the reference stars
+    # of the current hypotheses stay tracked, a frame costs one normalisation and one template
+    # score per hypothesis instead of all-pairs normalisation against every template.
+    # Full re-matching only runs when tracking breaks (or every `rematch_interval` frames).
+
+    def __init__(self, k=3, max_shift_fraction=0.05, min_tracked=0.6, rematch_interval=30):
+        self.k = k
+        self.max_shift_fraction = max_shift_fraction  # Largest star movement between frames, as a fraction of the diagonal
+        self.min_tracked = min_tracked  # Fraction of the previous stars that must be found again
+        self.rematch_interval = rematch_interval
+        self.reset()
+
+    def reset(self):
+        self.x = None
+        self.y = None
+        self.shift = np.zeros(2)  # Last frame-to-frame pan, used to predict the next positions
+        self.hypotheses = []  # Ranked matches, each with the (first, second) reference stars it was normalised on
+        self.other_scores = 0.0
+        self.frames_since_match = 0
+
+    def trackStars(self, x, y, max_shift):
+        # Greedy nearest-neighbour matching of the previous stars (shifted by the last pan) to the
+        # new ones. Returns {previous index: current index} and the median shift of the matches.
+        previous = np.column_stack((self.x, self.y)) + self.shift
+        current = np.column_stack((x, y)).astype(float)
+        distances = np.linalg.norm(previous[:, None, :] - current[None, :, :], axis=2)
+
+        mapping = {}
+        used = set()
+        for flat in np.argsort(distances, axis=None):
+            i, j = np.unravel_index(flat, distances.shape)
+            if distances[i, j] > max_shift:
+                break
+            if i in mapping or j in used:
+                continue
+            mapping[int(i)] = int(j)
+            used.add(int(j))
+
+        if not mapping:
+            return mapping, self.shift
+        moves = [current[j] - np.array((self.x[i], self.y[i])) for i, j in mapping.items()]
+        return mapping, np.median(moves, axis=0)
+
+    def fullMatch(self, x, y, sorted_area, candidates=None):
+        # Same search as rankImage, but remembering which star pair each permutation used
+        test_coordinates, pairs = cvmodel.pairPermutations(x, y, cvmodel.countBrightStars(sorted_area))
+
+        # Every template is scored either way; ranking all of them also gives the score mass outside
+        # the top k, kept so tracked frames can still report score_share over all matching templates
+        template_coordinate = cvmodel.loadTemplates()
+        ranked = cvmodel.rankConstellations(test_coordinates, template_coordinate, len(template_coordinate), candidates)
+        self.other_scores = sum(result["score"] for result in ranked[self.k:])
+
+        ranked = ranked[:self.k]
+        for result in ranked:
+            result["pair"] = pairs[result["permutation"]]
+        return ranked
+
+    def trackedMatch(self, x, y, mapping):
+        # Re-score only the hypotheses whose reference stars were tracked into this frame
+        template_coordinate = cvmodel.loadTemplates()
+        ranked = []
+        for hypothesis in self.hypotheses:
+            first, second = hypothesis["pair"]
+            if first not in mapping or second not in mapping:
+                continue
+            pair = (mapping[first], mapping[second])
+            coordinates = cvmodel.normaliseAroundPair(x, y, *pair)
+            result = cvmodel.rankConstellations([coordinates], template_coordinate, 1, [hypothesis["constellation"]])
+            if result:
+                result[0]["pair"] = pair
+                ranked.append(result[0])
+
+        total = self.other_scores + sum(result["score"] for result in ranked)
+        for result in ranked:
+            result["score_share"] = result["score"] / total
+        ranked.sort(key=lambda result: result["score"], reverse=True)
+        return ranked
+
+    def process(self, img, candidates=None):
+        # Recognise one grayscale frame; returns the ranked matches and whether tracking was used
+        x, y, sorted_area = cvmodel.getStarCentroids(cvmodel.detectStarContours(img))
+        if len(x) < 2:
+            # Not enough stars to normalise on, so there is nothing to track either
+            self.reset()
+            return {"tracked": False, "stars": len(x), "candidates": []}
+
+        ranked = []
+        tracked = False
+        if self.x is not None and self.hypotheses and self.frames_since_match < self.rematch_interval:
+            max_shift = self.max_shift_fraction * np.hypot(*img.shape[:2])
+            mapping, shift = self.trackStars(x, y, max_shift)
+            if len(mapping) >= self.min_tracked * len(self.x):
+                ranked = self.trackedMatch(x, y, mapping)
+                tracked = bool(ranked)
+                self.shift = shift
+
+        if not tracked:
+            # Tracking broke (or nothing to track yet): match the frame from scratch
+            ranked = self.fullMatch(x, y, sorted_area, candidates)
+            self.shift = np.zeros(2)
+            self.frames_since_match = 0
+        else:
+            self.frames_since_match += 1
+
+        self.x, self.y = x, y
+        self.hypotheses = ranked
+
+        # The pair indices only mean something inside the tracker
+        results = [{key: value for key, value in result.items() if key != "pair"} for result in ranked]
+        return {"tracked": tracked, "stars": len(x), "candidates": results}